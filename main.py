@@ -1,13 +1,111 @@
 import os
 import io
-from typing import Tuple
-
+import re
+import asyncio
+import atexit
+import hashlib
+import math
+import threading
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from typing import AsyncIterator, List, Tuple
+
+import numpy as np
 from fastapi import FastAPI, File, UploadFile, Form, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import Response, StreamingResponse, JSONResponse
 from PIL import Image, ImageDraw, ImageFont
 
-app = FastAPI()
+try:
+    import numba
+    from numba import njit, prange
+except ImportError:  # optional: fall back to the NumPy kernels
+    njit = None
+else:
+    # TBB keeps the interpreter from exiting once a kernel has run off the
+    # main thread (so uvicorn cannot shut down), so prefer OpenMP
+    if "NUMBA_THREADING_LAYER_PRIORITY" not in os.environ:
+        numba.config.THREADING_LAYER_PRIORITY = ["omp", "tbb", "workqueue"]
+
+# Database is optional; resolve it once at startup instead of on every /test
+try:
+    from database import db as _DB
+    _DB_ERROR = None
+except ImportError:
+    _DB = None
+    _DB_ERROR = "❌ Database module not found (run enable-database first)"
+except Exception as e:
+    _DB = None
+    _DB_ERROR = f"❌ Error: {str(e)[:50]}"
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Run a tiny image through the pipeline so Numba kernels are compiled
+    # (or loaded from cache) before the first real request
+    buf = io.BytesIO()
+    Image.new("RGB", (8, 8), (255, 255, 255)).save(buf, format="PNG")
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(_POOL, _process_sync, buf.getvalue(), "light")
+    yield
+
+
+app = FastAPI(lifespan=lifespan)
+
+# Opacity (0-255) of the original image blended over the result
+WATERMARK_ALPHA = 25
+
+# Output encoders: name -> (PIL format, media type, save params).
+# PNG uses compress_level=1 instead of the default 6, which trades ~20%
+# larger files for roughly 3x faster encoding.
+OUTPUT_FORMATS = {
+    "webp": ("WEBP", "image/webp", {"quality": 85, "method": 4}),
+    "jpeg": ("JPEG", "image/jpeg", {"quality": 85, "optimize": False, "progressive": True}),
+    "png": ("PNG", "image/png", {"compress_level": 1}),
+}
+OUTPUT_FORMATS["jpg"] = OUTPUT_FORMATS["jpeg"]
+
+# Hard limits on uploads, checked before any full decode. PIL itself refuses
+# images over twice MAX_IMAGE_PIXELS.
+MAX_UPLOAD_BYTES = 20 * 1024 * 1024
+MAX_BATCH_FILES = 32
+MAX_IMAGE_PIXELS = 40_000_000
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+# Uploads larger than this on either side are downscaled before processing,
+# unless the caller asks for another limit (0 keeps full resolution)
+MAX_IMAGE_DIM = 1600
+
+# Only backgrounds up to this size are cached (~6 MB each, 16 entries), which
+# covers the default downscaled sizes; full-resolution sizes rarely repeat
+BACKGROUND_CACHE_MAX_PIXELS = 2_000_000
+
+# Bradley-Roth adaptive threshold: window side is max(w, h) // divisor and a
+# pixel counts as text when it is this many percent darker than its window
+ADAPTIVE_WINDOW_DIVISOR = 8
+ADAPTIVE_T_PERCENT = 15
+
+# PNG outputs over this many pixels are streamed so the first IDAT chunks go
+# out sooner. Everything else is encoded in memory and sent in one Response;
+# the WebP and JPEG encoders write the whole file in one call anyway.
+STREAM_MIN_PIXELS = 1_000_000
+
+# Seconds a streaming encoder waits for a stalled client before giving up
+STREAM_WRITE_TIMEOUT = 30
+
+# Shared worker pool for the CPU-bound pipeline, plus a separate bounded pool
+# for streaming encoders, which block while slow clients drain their output
+_POOL = ThreadPoolExecutor(
+    max_workers=max(2, os.cpu_count() or 2), thread_name_prefix="ocr"
+)
+_ENCODE_POOL = ThreadPoolExecutor(
+    max_workers=max(2, os.cpu_count() or 2), thread_name_prefix="encode"
+)
+atexit.register(_POOL.shutdown)
+atexit.register(_ENCODE_POOL.shutdown)
 
 app.add_middleware(
     CORSMiddleware,
@@ -28,119 +126,511 @@ def health():
     return {"status": "ok"}
 
 
+# Theme palettes: name -> (top color, bottom color, text color)
+THEMES = {
+    "light": ((250, 250, 250), (240, 240, 245), (17, 24, 39)),
+    "dark": ((11, 12, 16), (18, 19, 24), (245, 245, 245)),
+    "blue": ((219, 234, 254), (191, 219, 254), (17, 24, 39)),
+    "brand": ((250, 245, 255), (236, 233, 255), (24, 24, 27)),
+    "purple": ((238, 233, 255), (221, 214, 254), (30, 27, 75)),
+    "emerald": ((209, 250, 229), (167, 243, 208), (6, 78, 59)),
+    "rose": ((255, 228, 230), (254, 205, 211), (76, 5, 25)),
+    "slate": ((248, 250, 252), (226, 232, 240), (15, 23, 42)),
+    # Dark futuristic with neon fuchsia text for contrast
+    "cyber": ((10, 10, 16), (20, 14, 40), (218, 70, 239)),
+}
+
+
 # Helper to build themed background
 
 def build_background(size: Tuple[int, int], theme: str):
     width, height = size
     theme = (theme or "light").lower()
+    if theme not in THEMES:
+        theme = "light"
+    if width * height > BACKGROUND_CACHE_MAX_PIXELS:
+        return _render_background(width, height, theme)
+    return _background_template(width, height, theme)
+
+
+# Templates may be shared across requests, so the array is read-only
+
+def _render_background(width: int, height: int, theme: str):
+    color1, color2, text_color = THEMES[theme]
+
+    bg_arr = np.empty((height, width, 3), dtype=np.uint8)
+    half = height // 2
+    bg_arr[:half] = color1
+    bg_arr[half:] = color2
+    bg_arr.setflags(write=False)
+    return bg_arr, text_color
 
-    # Defaults
-    color1 = (250, 250, 250)
-    color2 = (240, 240, 245)
-    text_color = (17, 24, 39)
-
-    if theme == "dark":
-        color1 = (11, 12, 16)
-        color2 = (18, 19, 24)
-        text_color = (245, 245, 245)
-    elif theme == "blue":
-        color1 = (219, 234, 254)
-        color2 = (191, 219, 254)
-        text_color = (17, 24, 39)
-    elif theme == "brand":
-        color1 = (250, 245, 255)
-        color2 = (236, 233, 255)
-        text_color = (24, 24, 27)
-    elif theme == "purple":
-        color1 = (238, 233, 255)
-        color2 = (221, 214, 254)
-        text_color = (30, 27, 75)
-    elif theme == "emerald":
-        color1 = (209, 250, 229)
-        color2 = (167, 243, 208)
-        text_color = (6, 78, 59)
-    elif theme == "rose":
-        color1 = (255, 228, 230)
-        color2 = (254, 205, 211)
-        text_color = (76, 5, 25)
-    elif theme == "slate":
-        color1 = (248, 250, 252)
-        color2 = (226, 232, 240)
-        text_color = (15, 23, 42)
-    elif theme == "cyber":
-        # Dark futuristic with neon text
-        color1 = (10, 10, 16)
-        color2 = (20, 14, 40)
-        text_color = (218, 70, 239)  # neon fuchsia for contrast
-
-    bg = Image.new("RGB", (width, height), color1)
-    top = Image.new("RGB", (width, height // 2), color1)
-    bottom = Image.new("RGB", (width, height - height // 2), color2)
-    bg.paste(top, (0, 0))
-    bg.paste(bottom, (0, height // 2))
-    return bg, text_color
+
+_background_template = lru_cache(maxsize=16)(_render_background)
+
+
+# Integer Rec. 601 luma: weights 77/150/29 sum to 256 so the divide is a shift
+
+def luminance(rgb):
+    y = np.multiply(rgb[..., 0], 77, dtype=np.uint16)
+    y += np.multiply(rgb[..., 1], 150, dtype=np.uint16)
+    y += np.multiply(rgb[..., 2], 29, dtype=np.uint16)
+    y += 128
+    y >>= 8
+    return y.astype(np.uint8)
+
+
+# Kernels are launched from worker threads. The workqueue layer (the last
+# resort when neither OpenMP nor TBB is available) aborts on concurrent
+# launches, so serialize them in that case and until a layer is chosen.
+
+_KERNEL_LOCK = threading.Lock()
+
+
+def _run_kernel(kernel, *args):
+    try:
+        serialize = numba.threading_layer() == "workqueue"
+    except ValueError:  # no parallel kernel has run yet
+        serialize = True
+    if serialize:
+        with _KERNEL_LOCK:
+            return kernel(*args)
+    return kernel(*args)
+
+
+# Text mask via adaptive threshold over an integral image, robust to uneven
+# lighting (e.g. photos of slips in shadow)
+
+def _window_bounds(n, half):
+    idx = np.arange(n)
+    return np.maximum(idx - half, 0), np.minimum(idx + half, n - 1)
+
+
+# Rows are processed in blocks of about this many pixels, so the int64
+# temporaries stay small regardless of image size
+_THRESHOLD_BLOCK_PIXELS = 1 << 20
+
+
+def _adaptive_threshold_numpy(arr, integral, half, t_percent):
+    h, w = arr.shape
+    x1, x2 = _window_bounds(w, half)
+    cols = x2 - x1 + 1
+    out = np.empty((h, w), dtype=np.uint8)
+    step = max(1, _THRESHOLD_BLOCK_PIXELS // w)
+    for start in range(0, h, step):
+        stop = min(start + step, h)
+        rows = np.arange(start, stop)
+        y1 = np.maximum(rows - half, 0)
+        y2 = np.minimum(rows + half, h - 1)
+        total = integral[np.ix_(y2 + 1, x2 + 1)]
+        total -= integral[np.ix_(y1, x2 + 1)]
+        total -= integral[np.ix_(y2 + 1, x1)]
+        total += integral[np.ix_(y1, x1)]
+        total *= 100 - t_percent
+        scaled = np.outer((y2 - y1 + 1) * 100, cols)
+        scaled *= arr[start:stop]
+        out[start:stop] = np.where(scaled < total, np.uint8(255), np.uint8(0))
+    return out
+
+
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def _adaptive_threshold_kernel(arr, integral, half, t_percent):
+        h, w = arr.shape
+        out = np.empty((h, w), dtype=np.uint8)
+        for y in prange(h):
+            y1 = max(y - half, 0)
+            y2 = min(y + half, h - 1)
+            for x in range(w):
+                x1 = max(x - half, 0)
+                x2 = min(x + half, w - 1)
+                count = (y2 - y1 + 1) * (x2 - x1 + 1)
+                total = (
+                    integral[y2 + 1, x2 + 1]
+                    - integral[y1, x2 + 1]
+                    - integral[y2 + 1, x1]
+                    + integral[y1, x1]
+                )
+                if np.int64(arr[y, x]) * count * 100 < total * (100 - t_percent):
+                    out[y, x] = 255
+                else:
+                    out[y, x] = 0
+        return out
+
+
+def adaptive_threshold(
+    arr,
+    window_divisor=ADAPTIVE_WINDOW_DIVISOR,
+    t_percent=ADAPTIVE_T_PERCENT,
+):
+    h, w = arr.shape
+    half = max(1, max(w, h) // window_divisor // 2)
+    # Zero-padded so window sums need no edge special-casing
+    integral = np.zeros((h + 1, w + 1), dtype=np.int64)
+    np.cumsum(arr, axis=0, dtype=np.int64, out=integral[1:, 1:])
+    np.cumsum(integral[1:, 1:], axis=1, out=integral[1:, 1:])
+    if njit is None:
+        return _adaptive_threshold_numpy(arr, integral, half, t_percent)
+    return _run_kernel(_adaptive_threshold_kernel, arr, integral, half, t_percent)
+
+
+# Compositing: theme text color over background where mask is set, then a
+# faint constant-alpha watermark of the original on top
+
+def _blend_numpy(orig, bg, mask, text_color, a):
+    text_rgb = np.array(text_color, dtype=np.uint16)
+    m = mask[..., None].astype(np.uint16)
+    base = (bg.astype(np.uint16) * (255 - m) + text_rgb * m + 127) // 255
+    # Constant-alpha lerp, done in place on the uint16 scratch buffer
+    base *= 255 - a
+    base += orig.astype(np.uint16) * a
+    base += 127
+    base //= 255
+    return base.astype(np.uint8)
+
+
+if njit is not None:
+    @njit(parallel=True, fastmath=False, cache=True)
+    def _blend_kernel(orig, bg, mask, text_r, text_g, text_b, a):
+        h, w = mask.shape
+        out = np.empty((h, w, 3), dtype=np.uint8)
+        text = (text_r, text_g, text_b)
+        for y in prange(h):
+            for x in range(w):
+                m = np.int32(mask[y, x])
+                for c in range(3):
+                    b = (np.int32(bg[y, x, c]) * (255 - m) + text[c] * m + 127) // 255
+                    out[y, x, c] = (b * (255 - a) + np.int32(orig[y, x, c]) * a + 127) // 255
+        return out
+
+
+def blend_layers(orig, bg, mask, text_color, a=WATERMARK_ALPHA):
+    if njit is None:
+        return _blend_numpy(orig, bg, mask, text_color, a)
+    r, g, b = (int(v) for v in text_color)
+    return _run_kernel(_blend_kernel, orig, bg, mask, r, g, b, int(a))
+
+
+# Streaming encoder: PIL writes encoded chunks from a pool thread, handing
+# them to the event loop, and the response consumes them asynchronously so no
+# server thread waits on a slow client. At most _STREAM_MAX_PENDING chunks may
+# be in flight; an encoder that cannot hand one off within
+# STREAM_WRITE_TIMEOUT gives up and frees its pool worker.
+
+class _ChunkWriter:
+    def __init__(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        q: asyncio.Queue,
+        slots: threading.Semaphore,
+        cancelled: threading.Event,
+    ):
+        self._loop = loop
+        self._q = q
+        self._slots = slots
+        self._cancelled = cancelled
+
+    def write(self, data) -> int:
+        if not data:
+            return 0
+        if self._cancelled.is_set():
+            raise OSError("Client disconnected")
+        if not self._slots.acquire(timeout=STREAM_WRITE_TIMEOUT):
+            raise OSError("Client stopped reading")
+        if self._cancelled.is_set():
+            raise OSError("Client disconnected")
+        self._loop.call_soon_threadsafe(self._q.put_nowait, bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+_STREAM_DONE = object()
+_STREAM_MAX_PENDING = 16
+
+
+async def stream_image(
+    image: Image.Image, format: str, **params
+) -> AsyncIterator[bytes]:
+    loop = asyncio.get_running_loop()
+    q: asyncio.Queue = asyncio.Queue()
+    slots = threading.Semaphore(_STREAM_MAX_PENDING)
+    cancelled = threading.Event()
+
+    def finish(item):
+        try:
+            loop.call_soon_threadsafe(q.put_nowait, item)
+        except RuntimeError:  # event loop already closed
+            pass
+
+    def encode():
+        try:
+            image.save(_ChunkWriter(loop, q, slots, cancelled), format=format, **params)
+        except Exception as e:
+            finish(e)
+        else:
+            finish(_STREAM_DONE)
+
+    _ENCODE_POOL.submit(encode)
+    try:
+        while True:
+            chunk = await q.get()
+            if chunk is _STREAM_DONE:
+                return
+            if isinstance(chunk, Exception):
+                raise chunk
+            slots.release()
+            yield chunk
+    finally:
+        # Wake the encoder if it is waiting for a slot so it sees the cancel
+        cancelled.set()
+        slots.release()
+
+
+# Decode an upload to RGB, letting libjpeg downscale in the DCT domain when
+# the image is much larger than we need and skipping the copy when it is
+# already RGB
+
+def decode_upload(contents: bytes, max_dim: int = MAX_IMAGE_DIM) -> Image.Image:
+    im = Image.open(io.BytesIO(contents))
+    # Header-only so far; refuse before committing memory to the decode
+    if im.size[0] * im.size[1] > MAX_IMAGE_PIXELS:
+        raise Image.DecompressionBombError("Image too large")
+    # Aspect-preserving target: PIL picks the JPEG scale from the smaller
+    # per-axis ratio, so a square box would barely reduce landscape photos
+    w, h = im.size
+    target = im.size
+    if max_dim > 0 and max(w, h) > max_dim:
+        scale = max_dim / max(w, h)
+        target = (math.ceil(w * scale), math.ceil(h * scale))
+    im.draft("RGB", target)
+    if im.mode != "RGB":
+        im = im.convert("RGB")
+    else:
+        im.load()
+    if max_dim > 0 and max(im.size) > max_dim:
+        im.thumbnail((max_dim, max_dim), Image.Resampling.BILINEAR)
+    return im
+
+
+# In-process LRU of encoded responses keyed by upload hash and options, so
+# repeated uploads (retries, batch re-runs) skip the pipeline entirely
+
+class _ResponseCache:
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._items: "OrderedDict[bytes, bytes]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: bytes):
+        with self._lock:
+            data = self._items.get(key)
+            if data is not None:
+                self._items.move_to_end(key)
+            return data
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._size = 0
+
+    def put(self, key: bytes, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+            self._items[key] = data
+            self._size += len(data)
+            while len(self._items) > self.max_entries or self._size > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self._size -= len(evicted)
+
+
+response_cache = _ResponseCache(max_entries=256, max_bytes=256 * 1024 * 1024)
+
+
+def response_cache_key(contents: bytes, *options: str) -> bytes:
+    digest = hashlib.blake2b(contents, digest_size=16).digest()
+    return digest + "\0".join(options).encode()
 
 
 # Fallback font loader
 
 def load_font(pixels: int) -> ImageFont.ImageFont:
-    size = max(10, int(pixels))
+    return _load_font(max(10, int(pixels)))
+
+
+@lru_cache(maxsize=32)
+def _load_font(size: int) -> ImageFont.ImageFont:
     try:
         return ImageFont.truetype("DejaVuSans.ttf", size=size)
     except Exception:
         return ImageFont.load_default()
 
 
+# CPU-bound pipeline, kept synchronous so it can run off the event loop
+
+def _process_sync(
+    contents: bytes, theme: str, max_dim: int = MAX_IMAGE_DIM
+) -> Image.Image:
+    try:
+        original = decode_upload(contents, max_dim)
+    except Image.DecompressionBombError:
+        raise HTTPException(status_code=413, detail="Image too large")
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid image data")
+
+    w, h = original.size
+
+    # Build background
+    bg_arr, text_color = build_background((w, h), theme)
+
+    # Text extraction via threshold mask (no external OCR deps):
+    # Works best for dark text on light slips; keeps layout by using pixel mask
+    orig_arr = np.asarray(original)
+    gray = luminance(orig_arr)
+    # Local threshold: marks pixels noticeably darker than their surroundings
+    mask_arr = adaptive_threshold(gray)
+
+    # Composite in one pass: place theme text color wherever the mask
+    # indicates text, then blend in a faint watermark of the original
+    # for context (very subtle, constant alpha)
+    out = blend_layers(orig_arr, bg_arr, mask_arr, text_color)
+    return Image.fromarray(out, "RGB")
+
+
+def encode_image(image: Image.Image, pil_format: str, save_params: dict) -> bytes:
+    buf = io.BytesIO()
+    image.save(buf, format=pil_format, **save_params)
+    return buf.getvalue()
+
+
+# Request options shared by /process and /process_batch
+
+def _resolve_encoder(format: str) -> Tuple[str, str, dict]:
+    encoder = OUTPUT_FORMATS.get((format or "webp").lower())
+    if encoder is None:
+        raise HTTPException(status_code=400, detail="Unsupported output format")
+    return encoder
+
+
+def _cache_key(contents: bytes, theme: str, pil_format: str, max_dim: int) -> bytes:
+    return response_cache_key(
+        contents, (theme or "light").lower(), pil_format, str(max_dim)
+    )
+
+
+async def read_upload(file: UploadFile) -> bytes:
+    contents = await file.read(MAX_UPLOAD_BYTES + 1)
+    if len(contents) > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail="Upload too large")
+    return contents
+
+
 @app.post("/process")
 async def process_image(
     file: UploadFile = File(...),
     theme: str = Form("light"),
+    format: str = Form("webp"),
+    max_dim: int = Form(MAX_IMAGE_DIM, ge=0),
 ):
     try:
-        contents = await file.read()
-        try:
-            original = Image.open(io.BytesIO(contents)).convert("RGB")
-        except Exception:
-            raise HTTPException(status_code=400, detail="Invalid image data")
-
-        w, h = original.size
-
-        # Build background
-        bg_img, text_color = build_background((w, h), theme)
-
-        # Text extraction via threshold mask (no external OCR deps):
-        # Works best for dark text on light slips; keeps layout by using pixel mask
-        gray = original.convert("L")
-        # Auto threshold using histogram percentile heuristic
-        hist = gray.histogram()
-        total = sum(hist)
-        cumsum = 0
-        thresh = 200
-        for i, v in enumerate(hist):
-            cumsum += v
-            if cumsum >= total * 0.7:  # assume ~70% background bright area
-                thresh = max(120, i)
-                break
-        mask = gray.point(lambda p: 255 if p < thresh else 0).convert("L")
-
-        # Create solid text layer using theme text color
-        text_layer = Image.new("RGB", (w, h), text_color)
-
-        # Composite: place text color wherever mask indicates text
-        composed = Image.composite(text_layer, bg_img, mask)
-
-        # Optional faint watermark of original for context (very subtle)
-        watermark = original.copy().convert("RGBA")
-        alpha = Image.new("L", (w, h), 25)  # very low opacity
-        watermark.putalpha(alpha)
-        composed = composed.convert("RGBA")
-        composed.alpha_composite(watermark)
-        composed = composed.convert("RGB")
+        pil_format, media_type, save_params = _resolve_encoder(format)
+
+        contents = await read_upload(file)
+        key = _cache_key(contents, theme, pil_format, max_dim)
+        cached = response_cache.get(key)
+        if cached is not None:
+            return Response(content=cached, media_type=media_type)
+
+        loop = asyncio.get_running_loop()
+        composed = await loop.run_in_executor(
+            _POOL, _process_sync, contents, theme, max_dim
+        )
+
+        stream = (
+            pil_format == "PNG"
+            and composed.width * composed.height > STREAM_MIN_PIXELS
+        )
+        if not stream:
+            data = await loop.run_in_executor(
+                _POOL, encode_image, composed, pil_format, save_params
+            )
+            response_cache.put(key, data)
+            return Response(content=data, media_type=media_type)
+
+        # Streamed outputs are not cached: collecting the body would hold
+        # it all in memory, which is what streaming avoids
+        return StreamingResponse(
+            stream_image(composed, pil_format, **save_params), media_type=media_type
+        )
 
+    except HTTPException:
+        raise
+    except Exception as e:
+        return JSONResponse(status_code=500, content={"error": str(e)})
+
+
+def _render_sync(
+    contents: bytes, theme: str, max_dim: int, pil_format: str, save_params: dict
+) -> bytes:
+    composed = _process_sync(contents, theme, max_dim)
+    return encode_image(composed, pil_format, save_params)
+
+
+def _zip_entry_stem(filename) -> str:
+    # Uploaded names are untrusted: drop any POSIX or Windows directory part
+    # and reduce the rest to a safe character set
+    name = re.split(r"[\\/]", filename or "")[-1]
+    stem = os.path.splitext(name)[0]
+    return re.sub(r"[^\w.-]", "_", stem) or "image"
+
+
+@app.post("/process_batch")
+async def process_batch(
+    files: List[UploadFile] = File(...),
+    theme: str = Form("light"),
+    format: str = Form("webp"),
+    max_dim: int = Form(MAX_IMAGE_DIM, ge=0),
+):
+    try:
+        pil_format, _, save_params = _resolve_encoder(format)
+        if len(files) > MAX_BATCH_FILES:
+            raise HTTPException(status_code=413, detail="Too many files in batch")
+        loop = asyncio.get_running_loop()
+
+        bodies = await asyncio.gather(*(read_upload(f) for f in files))
+
+        async def render(contents: bytes) -> bytes:
+            key = _cache_key(contents, theme, pil_format, max_dim)
+            data = response_cache.get(key)
+            if data is None:
+                data = await loop.run_in_executor(
+                    _POOL, _render_sync, contents, theme, max_dim, pil_format, save_params
+                )
+                response_cache.put(key, data)
+            return data
+
+        # Images render in parallel on worker threads
+        results = await asyncio.gather(*(render(b) for b in bodies))
+
+        # Outputs are already compressed, so store them as-is
         buf = io.BytesIO()
-        composed.save(buf, format="PNG")
-        buf.seek(0)
-        return StreamingResponse(buf, media_type="image/png")
+        ext = pil_format.lower()
+        with zipfile.ZipFile(buf, "w", zipfile.ZIP_STORED) as zf:
+            for i, (f, data) in enumerate(zip(files, results)):
+                zf.writestr(f"{i + 1:03d}_{_zip_entry_stem(f.filename)}.{ext}", data)
+
+        return Response(
+            content=buf.getvalue(),
+            media_type="application/zip",
+            headers={"Content-Disposition": 'attachment; filename="processed.zip"'},
+        )
 
     except HTTPException:
         raise
@@ -165,27 +655,21 @@ def test_database():
         "collections": []
     }
 
-    try:
-        from database import db
-
-        if db is not None:
-            response["database"] = "✅ Available"
-            response["database_url"] = "✅ Configured"
-            response["database_name"] = db.name if hasattr(db, 'name') else "✅ Connected"
-            response["connection_status"] = "Connected"
-            try:
-                collections = db.list_collection_names()
-                response["collections"] = collections[:10]
-                response["database"] = "✅ Connected & Working"
-            except Exception as e:
-                response["database"] = f"⚠️  Connected but Error: {str(e)[:50]}"
-        else:
-            response["database"] = "⚠️  Available but not initialized"
-
-    except ImportError:
-        response["database"] = "❌ Database module not found (run enable-database first)"
-    except Exception as e:
-        response["database"] = f"❌ Error: {str(e)[:50]}"
+    if _DB_ERROR is not None:
+        response["database"] = _DB_ERROR
+    elif _DB is not None:
+        response["database"] = "✅ Available"
+        response["database_url"] = "✅ Configured"
+        response["database_name"] = _DB.name if hasattr(_DB, 'name') else "✅ Connected"
+        response["connection_status"] = "Connected"
+        try:
+            collections = _DB.list_collection_names()
+            response["collections"] = collections[:10]
+            response["database"] = "✅ Connected & Working"
+        except Exception as e:
+            response["database"] = f"⚠️  Connected but Error: {str(e)[:50]}"
+    else:
+        response["database"] = "⚠️  Available but not initialized"
 
     response["database_url"] = "✅ Set" if os.getenv("DATABASE_URL") else "❌ Not Set"
     response["database_name"] = "✅ Set" if os.getenv("DATABASE_NAME") else "❌ Not Set"
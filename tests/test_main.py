@@ -0,0 +1,403 @@
+import asyncio
+import io
+import zipfile
+
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+from PIL import Image, ImageDraw
+
+import main
+
+
+def make_upload(size=(301, 203), fmt="JPEG", color=(230, 230, 225)) -> bytes:
+    im = Image.new("RGB", size, color)
+    draw = ImageDraw.Draw(im)
+    draw.text((10, 10), "TOTAL 12.34", fill=(20, 20, 20))
+    buf = io.BytesIO()
+    im.save(buf, fmt)
+    return buf.getvalue()
+
+
+@pytest.fixture
+def client():
+    main.response_cache.clear()
+    with TestClient(main.app) as c:
+        yield c
+    main.response_cache.clear()
+
+
+@pytest.fixture
+def pipeline_calls(monkeypatch):
+    calls = []
+    process_sync = main._process_sync
+
+    def counting(*args, **kwargs):
+        calls.append(args)
+        return process_sync(*args, **kwargs)
+
+    monkeypatch.setattr(main, "_process_sync", counting)
+    return calls
+
+
+def post_process(client, data, **fields):
+    return client.post(
+        "/process", files={"file": ("slip.jpg", data, "image/jpeg")}, data=fields
+    )
+
+
+# Response cache
+
+def test_repeat_upload_is_served_from_cache(client, pipeline_calls):
+    data = make_upload()
+    first = post_process(client, data, theme="dark")
+    second = post_process(client, data, theme="DARK")
+
+    assert first.status_code == second.status_code == 200
+    assert first.content == second.content
+    assert len(pipeline_calls) == 1
+
+
+@pytest.mark.parametrize(
+    "fields",
+    [{"theme": "blue"}, {"format": "png"}, {"max_dim": "100"}],
+)
+def test_cache_key_includes_options(client, pipeline_calls, fields):
+    data = make_upload()
+    assert post_process(client, data, theme="dark").status_code == 200
+    assert post_process(client, data, **{"theme": "dark", **fields}).status_code == 200
+
+    assert len(pipeline_calls) == 2
+
+
+def test_different_uploads_miss_cache(client, pipeline_calls):
+    post_process(client, make_upload(color=(230, 230, 225)))
+    post_process(client, make_upload(color=(200, 210, 220)))
+
+    assert len(pipeline_calls) == 2
+
+
+def test_response_cache_evicts_oldest():
+    cache = main._ResponseCache(max_entries=2, max_bytes=10)
+    cache.put(b"a", b"12345")
+    cache.put(b"b", b"12345")
+    cache.get(b"a")
+    cache.put(b"c", b"1")
+
+    assert cache.get(b"a") == b"12345"
+    assert cache.get(b"b") is None
+    assert cache.get(b"c") == b"1"
+
+
+# Upload limits
+
+def test_rejects_oversized_upload_bytes(client, monkeypatch):
+    monkeypatch.setattr(main, "MAX_UPLOAD_BYTES", 1000)
+    r = post_process(client, b"\0" * 1001)
+
+    assert r.status_code == 413
+    assert r.json()["detail"] == "Upload too large"
+
+
+def test_rejects_oversized_image_pixels(client, monkeypatch):
+    monkeypatch.setattr(main, "MAX_IMAGE_PIXELS", 100 * 100)
+    r = post_process(client, make_upload(size=(101, 100), fmt="PNG"))
+
+    assert r.status_code == 413
+    assert r.json()["detail"] == "Image too large"
+
+
+def test_rejects_negative_max_dim(client):
+    assert post_process(client, make_upload(), max_dim="-5").status_code == 422
+
+
+# Batch endpoint
+
+def test_process_batch_returns_zip(client):
+    files = [
+        ("files", ("a.jpg", make_upload(), "image/jpeg")),
+        ("files", ("dir/b.png", make_upload(size=(400, 300), fmt="PNG"), "image/png")),
+    ]
+    r = client.post(
+        "/process_batch", files=files, data={"format": "png", "max_dim": "200"}
+    )
+
+    assert r.status_code == 200
+    assert r.headers["content-type"] == "application/zip"
+    with zipfile.ZipFile(io.BytesIO(r.content)) as zf:
+        assert zf.namelist() == ["001_a.png", "002_b.png"]
+        sizes = [Image.open(zf.open(name)).size for name in zf.namelist()]
+    assert sizes == [(200, 135), (200, 150)]
+
+
+@pytest.mark.parametrize(
+    "filename, stem",
+    [
+        ("a.jpg", "a"),
+        ("dir/b.png", "b"),
+        ("a\\..\\..\\..\\x.jpg", "x"),
+        ("../../etc/passwd", "passwd"),
+        ("rec eipt:1?.jpg", "rec_eipt_1_"),
+        ("", "image"),
+        (None, "image"),
+    ],
+)
+def test_zip_entry_stem_is_safe(filename, stem):
+    assert main._zip_entry_stem(filename) == stem
+
+
+def test_process_batch_rejects_invalid_image(client):
+    files = [
+        ("files", ("a.jpg", make_upload(), "image/jpeg")),
+        ("files", ("b.jpg", b"junk", "image/jpeg")),
+    ]
+    r = client.post("/process_batch", files=files)
+
+    assert r.status_code == 400
+
+
+def test_process_batch_rejects_unsupported_output_format(client):
+    files = [("files", ("a.jpg", make_upload(), "image/jpeg"))]
+    r = client.post("/process_batch", files=files, data={"format": "gif"})
+
+    assert r.status_code == 400
+    assert r.json()["detail"] == "Unsupported output format"
+
+
+def test_process_batch_shares_cache_with_process(client, pipeline_calls):
+    data = make_upload()
+    post_process(client, data, theme="dark", format="png")
+    files = [("files", ("a.jpg", data, "image/jpeg"))]
+    r = client.post("/process_batch", files=files, data={"theme": "Dark", "format": "png"})
+
+    assert r.status_code == 200
+    assert len(pipeline_calls) == 1
+
+
+def test_process_batch_rejects_too_many_files(client, monkeypatch):
+    monkeypatch.setattr(main, "MAX_BATCH_FILES", 2)
+    files = [("files", ("a.jpg", make_upload(), "image/jpeg"))] * 3
+    r = client.post("/process_batch", files=files)
+
+    assert r.status_code == 413
+
+
+# NumPy fallbacks match the Numba kernels
+
+@pytest.fixture
+def rng():
+    return np.random.default_rng(0)
+
+
+def test_adaptive_threshold_numpy_matches_numba(rng):
+    pytest.importorskip("numba")
+    for shape in [(1, 1), (8, 8), (12, 15), (3, 50), (203, 301), (480, 640)]:
+        arr = rng.integers(0, 256, shape, dtype=np.uint8)
+        arr[: shape[0] // 2] //= 3
+        h, w = shape
+        half = max(1, max(w, h) // main.ADAPTIVE_WINDOW_DIVISOR // 2)
+        integral = np.zeros((h + 1, w + 1), dtype=np.int64)
+        integral[1:, 1:] = arr.astype(np.int64).cumsum(0).cumsum(1)
+
+        expected = main._adaptive_threshold_kernel(arr, integral, half, 15)
+        actual = main._adaptive_threshold_numpy(arr, integral, half, 15)
+        np.testing.assert_array_equal(actual, expected)
+
+
+@pytest.mark.parametrize("side", [8, 12, 15, 16, 64])
+def test_adaptive_threshold_marks_dark_bar(side):
+    arr = np.full((side, side), 230, dtype=np.uint8)
+    arr[side // 2, 1:-1] = 20
+
+    mask = main.adaptive_threshold(arr)
+
+    assert mask[side // 2, 1:-1].all()
+    assert not mask[0].any()
+
+
+def test_blend_numpy_matches_numba(rng):
+    pytest.importorskip("numba")
+    orig = rng.integers(0, 256, (50, 70, 3), dtype=np.uint8)
+    bg = rng.integers(0, 256, (50, 70, 3), dtype=np.uint8)
+    mask = np.where(rng.random((50, 70)) < 0.3, 255, 0).astype(np.uint8)
+
+    expected = main._blend_kernel(orig, bg, mask, 218, 70, 239, 25)
+    actual = main._blend_numpy(orig, bg, mask, (218, 70, 239), 25)
+    np.testing.assert_array_equal(actual, expected)
+
+
+# Streaming encoder
+
+def noise_image(size=(800, 800)) -> Image.Image:
+    rng = np.random.default_rng(0)
+    return Image.fromarray(rng.integers(0, 256, (size[1], size[0], 3), dtype=np.uint8))
+
+
+def test_stream_image_yields_whole_encoding():
+    image = noise_image()
+
+    async def collect():
+        return b"".join([chunk async for chunk in main.stream_image(image, "PNG")])
+
+    data = asyncio.run(collect())
+    buf = io.BytesIO()
+    image.save(buf, "PNG")
+    assert data == buf.getvalue()
+
+
+def test_stalled_stream_releases_encoder(monkeypatch):
+    monkeypatch.setattr(main, "STREAM_WRITE_TIMEOUT", 0.2)
+    monkeypatch.setattr(main, "_STREAM_MAX_PENDING", 1)
+    image = noise_image()
+
+    async def stall_then_read():
+        chunks = main.stream_image(image, "PNG", compress_level=0)
+        await chunks.__anext__()
+        # Stop reading long enough for the encoder to give up
+        await asyncio.sleep(1)
+        with pytest.raises(OSError, match="stopped reading"):
+            async for _ in chunks:
+                pass
+
+    asyncio.run(stall_then_read())
+
+
+def test_large_png_is_streamed_and_not_cached(client):
+    data = make_upload(size=(1400, 1000))
+    r = post_process(client, data, format="png")
+
+    assert r.status_code == 200
+    assert r.headers["content-type"] == "image/png"
+    assert "content-length" not in r.headers
+    assert Image.open(io.BytesIO(r.content)).size == (1400, 1000)
+    assert len(main.response_cache._items) == 0
+
+
+def test_large_webp_is_buffered_and_cached(client):
+    r = post_process(client, make_upload(size=(1400, 1000)), format="webp")
+
+    assert r.status_code == 200
+    assert int(r.headers["content-length"]) == len(r.content)
+    assert len(main.response_cache._items) == 1
+
+
+# Output formats
+
+@pytest.mark.parametrize(
+    "fmt, media_type, pil_format",
+    [
+        (None, "image/webp", "WEBP"),
+        ("webp", "image/webp", "WEBP"),
+        ("JPG", "image/jpeg", "JPEG"),
+        ("jpeg", "image/jpeg", "JPEG"),
+        ("png", "image/png", "PNG"),
+    ],
+)
+def test_output_format_sets_media_type(client, fmt, media_type, pil_format):
+    fields = {"format": fmt} if fmt else {}
+    r = post_process(client, make_upload(), **fields)
+
+    assert r.status_code == 200
+    assert r.headers["content-type"] == media_type
+    assert Image.open(io.BytesIO(r.content)).format == pil_format
+
+
+def test_rejects_unsupported_output_format(client):
+    r = post_process(client, make_upload(), format="gif")
+
+    assert r.status_code == 400
+    assert r.json()["detail"] == "Unsupported output format"
+
+
+# Upload decoding
+
+def test_decode_upload_downscales_jpeg_in_draft(monkeypatch):
+    thumbnails = []
+    thumbnail = Image.Image.thumbnail
+
+    def spy(self, *args, **kwargs):
+        thumbnails.append(self.size)
+        return thumbnail(self, *args, **kwargs)
+
+    monkeypatch.setattr(Image.Image, "thumbnail", spy)
+    data = make_upload(size=(4000, 3000))
+
+    # libjpeg's DCT scaling alone reaches the target
+    assert main.decode_upload(data, 2000).size == (2000, 1500)
+    assert thumbnails == []
+    # Draft decodes at 1/2 scale, then thumbnail finishes the job
+    assert main.decode_upload(data, 1600).size == (1600, 1200)
+    assert thumbnails == [(2000, 1500)]
+
+
+def test_decode_upload_full_resolution_and_modes():
+    assert main.decode_upload(make_upload(size=(4000, 3000)), 0).size == (4000, 3000)
+
+    buf = io.BytesIO()
+    Image.new("L", (300, 200), 128).save(buf, "PNG")
+    im = main.decode_upload(buf.getvalue())
+    assert (im.mode, im.size) == ("RGB", (300, 200))
+
+
+# Luminance
+
+def test_luminance_matches_pil_within_one_level(rng):
+    rgb = rng.integers(0, 256, (120, 160, 3), dtype=np.uint8)
+    expected = np.asarray(Image.fromarray(rgb).convert("L")).astype(int)
+
+    actual = main.luminance(rgb)
+
+    assert actual.dtype == np.uint8
+    assert np.abs(actual.astype(int) - expected).max() <= 1
+
+
+def test_luminance_extremes():
+    rgb = np.array([[[0, 0, 0], [255, 255, 255]]], dtype=np.uint8)
+    np.testing.assert_array_equal(main.luminance(rgb), [[0, 255]])
+
+
+# Database status
+
+class FakeDB:
+    name = "slips"
+
+    def __init__(self, collections=None, error=None):
+        self._collections = collections or []
+        self._error = error
+
+    def list_collection_names(self):
+        if self._error:
+            raise self._error
+        return self._collections
+
+
+def test_status_with_preloaded_db(client, monkeypatch):
+    monkeypatch.setattr(main, "_DB", FakeDB(collections=["a", "b"]))
+    monkeypatch.setattr(main, "_DB_ERROR", None)
+    body = client.get("/test").json()
+
+    assert body["database"] == "✅ Connected & Working"
+    assert body["connection_status"] == "Connected"
+    assert body["collections"] == ["a", "b"]
+
+
+def test_status_when_db_query_fails(client, monkeypatch):
+    monkeypatch.setattr(main, "_DB", FakeDB(error=RuntimeError("refused")))
+    monkeypatch.setattr(main, "_DB_ERROR", None)
+    body = client.get("/test").json()
+
+    assert body["database"] == "⚠️  Connected but Error: refused"
+
+
+def test_status_reports_import_error(client, monkeypatch):
+    monkeypatch.setattr(main, "_DB", None)
+    monkeypatch.setattr(main, "_DB_ERROR", "❌ Error: boom")
+
+    assert client.get("/test").json()["database"] == "❌ Error: boom"
+
+
+def test_status_without_db(client, monkeypatch):
+    monkeypatch.setattr(main, "_DB", None)
+    monkeypatch.setattr(main, "_DB_ERROR", None)
+
+    assert client.get("/test").json()["database"] == "⚠️  Available but not initialized"